@@ -1,7 +1,8 @@
-from typing import Optional
+from typing import Optional, Tuple, Union
 
 import torch
 from torch import nn, Tensor
+from torch.nn import functional as F
 
 from WaveNet import WaveNet
 
@@ -64,29 +65,52 @@ class ResidualCouplingBlock(nn.Module):
           mean_only=True
         )
       )
+      # Flip 不再被调用，保留它只是为了维持 state_dict 中各层的下标，兼容已有的 checkpoint
       self.flows.append(Flip())
 
-  def forward(self, x: Tensor, x_mask: Tensor, g: Optional[Tensor] = None, reverse=False):
+  def forward(self, x: Tensor, x_mask: Tensor, g: Optional[Tensor] = None, reverse: bool = False):
     """
     设置 reverse=True 用于推理。
 
+    每层之后的 Flip 会把通道倒序，第 i 层看到的是翻转了 i 次的输入。
+    这里不实际翻转张量，而是让奇数层以 flipped=True 在未翻转的张量上计算等价的结果，
+    只在 flow 数为奇数时于首尾翻转一次。
+
     :param x: :math:`[B, C, T]`
     :param x_mask: :math:`[B, 1, T]`
     :param g: :math:`[B, C, 1]`
     """
 
+    # 单条语音推理时没有 padding，mask 全为 1，此时各耦合层跳过所有与 mask 的乘法；整个 flow 只检查一次
+    # torch.compile / torch.export 下保留乘法：数据相关的分支会打断或阻止图捕获，而乘法本身会被融合
+    masked = self.training or torch.compiler.is_compiling() or bool(x_mask.min() < 1)
+
+    # 耦合层位于 flows 的偶数下标，直接按下标取用，不对 ModuleList 切片
     if not reverse:
-      for flow in self.flows:
-        x, _ = flow(x, x_mask, g=g, reverse=reverse)
+      for i in range(self.n_flows):
+        x, _ = self.flows[2 * i](x, x_mask, g=g, reverse=reverse, flipped=i % 2 == 1, masked=masked)
+
+      if self.n_flows % 2 == 1:
+        x = torch.flip(x, [1])
     else:
-      for flow in reversed(self.flows):
-        x = flow(x, x_mask, g=g, reverse=reverse)
+      if self.n_flows % 2 == 1:
+        x = torch.flip(x, [1])
+
+      for i in range(self.n_flows - 1, -1, -1):
+        x = self.flows[2 * i](x, x_mask, g=g, reverse=reverse, flipped=i % 2 == 1, masked=masked)
 
     return x
 
+  def remove_weight_norm(self):
+    for flow in self.flows:
+      if isinstance(flow, ResidualCouplingLayer):
+        flow.enc.remove_weight_norm()
+
 
 class Flip(nn.Module):
-  def forward(self, x, *args, reverse=False, **kwargs):
+  def forward(
+      self, x: Tensor, x_mask: Tensor, g: Optional[Tensor] = None, reverse: bool = False
+  ) -> Union[Tensor, Tuple[Tensor, Tensor]]:
     x = torch.flip(x, [1])
 
     if not reverse:
@@ -104,7 +128,7 @@ class ResidualCouplingLayer(nn.Module):
       kernel_size: int,
       dilation_rate: int,
       n_layers: int,
-      p_dropout: int = 0,
+      p_dropout: float = 0.,
       gin_channels: int = 0,
       mean_only=False
   ):
@@ -137,32 +161,98 @@ class ResidualCouplingLayer(nn.Module):
     self.post.weight.data.zero_()
     self.post.bias.data.zero_()  # type: ignore
 
-  def forward(self, x: Tensor, x_mask: Tensor, g: Optional[Tensor] = None, reverse=False):
+  def forward(
+      self,
+      x: Tensor,
+      x_mask: Tensor,
+      g: Optional[Tensor] = None,
+      reverse: bool = False,
+      flipped: bool = False,
+      masked: bool = True
+  ) -> Union[Tensor, Tuple[Tensor, Tensor]]:
     """
     设置 reverse=True 用于推理。
+    设置 flipped=True 等价于 flip(layer(flip(x)))，但只倒序 1x1 卷积的权重，不复制激活。
+    设置 masked=False 跳过所有与 mask 的乘法，仅在 mask 全为 1 时使用，由 ResidualCouplingBlock 统一判断。
 
     :param x: :math:`[B, C, T]`
     :param x_mask: :math:`[B, 1, T]`
     :param g: :math:`[B, C, 1]`
     """
 
-    x0, x1 = torch.split(x, [self.half_channels] * 2, 1)
-    h = self.pre(x0) * x_mask
+    # flipped 时固定部分与变换部分在通道维上交换位置
+    i0 = self.half_channels if flipped else 0
+    i1 = 0 if flipped else self.half_channels
+
+    # 切片视图代替 torch.split，x0 保持不变
+    x0 = x[:, i0:i0 + self.half_channels]
+    x1 = x[:, i1:i1 + self.half_channels]
+
+    if not flipped:
+      h = self.pre(x0)
+    else:
+      h = F.conv1d(x0, self.pre.weight.flip(1), self.pre.bias)
+
+    if masked:
+      h = h * x_mask
+
     h = self.enc(h, x_mask, g=g)
-    stats = self.post(h) * x_mask
 
-    if not self.mean_only:
-      m, logs = torch.split(stats, [self.half_channels] * 2, 1)
+    if not flipped:
+      stats = self.post(h)
     else:
+      post_bias = self.post.bias
+      if post_bias is not None:
+        post_bias = self._flip_stats(post_bias)
+
+      stats = F.conv1d(h, self._flip_stats(self.post.weight), post_bias)
+
+    if masked:
+      stats = stats * x_mask
+
+    logs: Optional[Tensor] = None
+
+    if self.mean_only:
+      # logs 恒为 0，即 exp(logs) = 1 且 logdet = 0，省去 zeros_like 与整条 exp/mul 链
       m = stats
-      logs = torch.zeros_like(m)
 
-    if not reverse:
-      x1 = m + x1 * torch.exp(logs) * x_mask
-      x = torch.cat([x0, x1], 1)
-      logdet = torch.sum(logs, [1, 2])
-      return x, logdet
+      if not reverse:
+        x1 = x1 + m
+      else:
+        x1 = x1 - m
     else:
-      x1 = (x1 - m) * torch.exp(-logs) * x_mask
-      x = torch.cat([x0, x1], 1)
-      return x
+      m, logs = torch.split(stats, [self.half_channels] * 2, 1)
+
+      if not reverse:
+        x1 = torch.addcmul(m, x1, torch.exp(logs))
+      else:
+        x1 = (x1 - m).mul_(torch.exp(-logs))
+
+    if masked:
+      x1 = x1.mul_(x_mask)
+
+    if not flipped:
+      out = torch.cat([x0, x1], 1)
+    else:
+      out = torch.cat([x1, x0], 1)
+
+    if reverse:
+      return out
+
+    # 推理时 logdet 会被丢弃，无需求和
+    if logs is None or (not self.training and not torch.is_grad_enabled()):
+      logdet = x.new_zeros(x.size(0))
+    else:
+      logdet = torch.sum(logs, [1, 2])
+
+    return out, logdet
+
+  def _flip_stats(self, w: Tensor) -> Tensor:
+    """
+    将 post 的输出通道（m 与 logs 各自）倒序
+    """
+
+    if self.mean_only:
+      return w.flip(0)
+
+    return torch.cat([w[:self.half_channels].flip(0), w[self.half_channels:].flip(0)], 0)
@@ -1,5 +1,7 @@
+from typing import Optional
+
 import torch
-from torch import nn
+from torch import nn, Tensor
 
 import commons
 
@@ -12,7 +14,7 @@ class WaveNet(torch.nn.Module):
       dilation_rate,
       n_layers,
       gin_channels=0,
-      p_dropout=0
+      p_dropout=0.
   ):
     """
     Wavenet层，采用权重归一化，且没有输入条件。
@@ -70,15 +72,15 @@ class WaveNet(torch.nn.Module):
       res_skip_layer = torch.nn.utils.weight_norm(res_skip_layer, name='weight')
       self.res_skip_layers.append(res_skip_layer)
 
-  def forward(self, x, x_mask, g=None, **kwargs):
+  def forward(self, x: Tensor, x_mask: Tensor, g: Optional[Tensor] = None):
     output = torch.zeros_like(x)
-    n_channels_tensor = torch.IntTensor([self.hidden_channels])
+    n_channels_tensor = torch.tensor([self.hidden_channels], dtype=torch.int)
 
     if g is not None:
       g = self.cond_layer(g)
 
-    for i in range(self.n_layers):
-      x_in = self.in_layers[i](x)
+    for i, (in_layer, res_skip_layer) in enumerate(zip(self.in_layers, self.res_skip_layers)):
+      x_in = in_layer(x)
       if g is not None:
         cond_offset = i * 2 * self.hidden_channels
         g_l = g[:, cond_offset:cond_offset + 2 * self.hidden_channels, :]
@@ -91,7 +93,7 @@ class WaveNet(torch.nn.Module):
         n_channels_tensor)
       acts = self.drop(acts)
 
-      res_skip_acts = self.res_skip_layers[i](acts)
+      res_skip_acts = res_skip_layer(acts)
       if i < self.n_layers - 1:
         res_acts = res_skip_acts[:, :self.hidden_channels, :]
         x = (x + res_acts) * x_mask
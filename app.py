@@ -1,29 +1,100 @@
 import argparse
+import functools
+import hashlib
+import os
 
 import gradio as gr
 import torch
+from torch.nn import functional as F
 
 import commons
 import utils
+from ResidualCouplingBlock import ResidualCouplingLayer
 from SynthesizerTrn import SynthesizerTrn
 from text import cleaned_text_to_sequence
 from text.cleaners import clean_text
 from text.symbols import symbols
 
 
-# we use Kyubyong/g2p for demo instead of our internal g2p
-# https://github.com/Kyubyong/g2p
-def get_text(text, hps):
+# 文本清洗（含 G2P）只依赖输入文本，同一段文本重复合成（如换 seed 对比）时直接命中缓存
+# 缓存的结果转为元组，避免被调用方修改
+@functools.lru_cache(maxsize=256)
+def _clean_text(text):
   cleaned_text, lang = clean_text(text)
-  text_norm = cleaned_text_to_sequence(cleaned_text)
-  if hps.data.add_blank:
-    text_norm, lang = commons.intersperse_with_language_id(text_norm, lang, 0)
-  text_norm = torch.LongTensor(text_norm)
-  lang = torch.LongTensor(lang)
-  return text_norm, lang, cleaned_text
+  return cleaned_text, tuple(lang)
+
+
+@functools.lru_cache(maxsize=256)
+def _text_to_ids(cleaned_text):
+  return tuple(cleaned_text_to_sequence(cleaned_text))
+
+
+def _state_hash(module):
+  # 按参数内容计算指纹，用于判断磁盘上的导出产物是否与当前加载的权重一致
+  h = hashlib.sha1()
+
+  for k, v in module.state_dict().items():
+    h.update(k.encode())
+    h.update(v.detach().flatten().view(torch.uint8).numpy().tobytes())
+
+  return h.hexdigest()[:16]
+
+
+def _to_bf16(module, args, kwargs):
+  def cast(v):
+    return v.to(torch.bfloat16) if torch.is_tensor(v) and v.is_floating_point() else v
+
+  return tuple(cast(v) for v in args), {k: cast(v) for k, v in kwargs.items()}
+
+
+class AOTFlow(torch.nn.Module):
+  """
+  按帧长分桶、经 AOTInductor 预编译的 flow，只用于推理（reverse=True）。
+  输入在时间维补零到最近的桶长度后交给对应的编译产物，超出最大的桶时回退到原始的 flow。
+  """
+
+  def __init__(self, flow, runners):
+    super().__init__()
+    self.flow = flow
+    self.runners = runners
+    self.buckets = sorted(runners)
+
+  @torch.compiler.disable
+  def forward(self, x, x_mask, g=None, reverse=False):
+    t = x.size(-1)
+    bucket = next((b for b in self.buckets if b >= t), None)
+
+    if not reverse or g is None or bucket is None:
+      return self.flow(x, x_mask, g=g, reverse=reverse)
+
+    # 补零部分的 mask 为 0，flow 内部会将其屏蔽，不影响有效部分的结果
+    pad = bucket - t
+    z = self.runners[bucket](F.pad(x, (0, pad)), F.pad(x_mask, (0, pad)), g, reverse=True)
+
+    return z[:, :, :t]
+
+
+class CompiledFlow(torch.nn.Module):
+  """
+  单独编译的 flow，只用于推理。
+  帧长取决于预测的时长而不是文本长度，与 infer_pre_decoder 分开编译后，可以直接按帧长预热。
+  """
+
+  def __init__(self, flow):
+    super().__init__()
+    self.flow = flow
+    self.compiled = torch.compile(flow, mode="reduce-overhead", fullgraph=False, dynamic=True)
+
+  @torch.compiler.disable
+  def forward(self, x, x_mask, g=None, reverse=False):
+    return self.compiled(x, x_mask, g=g, reverse=reverse)
 
 
 class GradioApp:
+  MAX_LEN = 1024
+  # 取自 ATen 的私有启发式：CPU 上 fp32 卷积按输入的元素数是否超过该值选择实现
+  # bf16 或其他版本的 torch 未必使用同一阈值，届时按它导出的长度只是多预热几次
+  CONV_SIZE_LIMIT = 20480
 
   def __init__(self, args):
     self.hps = utils.get_hparams_from_file(args.config)
@@ -43,11 +114,246 @@ class GradioApp:
 
     _ = self.net_g.eval()
     _ = utils.load_checkpoint(args.checkpoint_path, model_g=self.net_g)
+    torch.set_grad_enabled(False)
+
+    self._infer_pre = self.net_g.infer_pre_decoder
+    self._infer_dec = self.net_g.infer_decode_chunk
+
+    if args.onnx:
+      # 需在转换精度之前导出，ONNX 解码器始终使用 fp32 权重
+      self._infer_dec = self._onnx_decoder(args.onnx)
+
+    if args.bf16:
+      # flow 与解码器以卷积为主且受内存带宽限制，bf16 权重减半访存量，在支持 AVX-512 BF16 的 CPU 上还能用上原生内核
+      # 文本编码器与时长预测器保持 fp32：时长经 ceil 取整，低精度会改变音频的长度
+      self.net_g.flow.to(torch.bfloat16)
+      self.net_g.waveform_decoder.to(torch.bfloat16)
+
+    if args.jit:
+      self._freeze_flow()
+
+    if args.aot:
+      name = os.path.splitext(os.path.basename(args.checkpoint_path))[0]
+      self._aot_flow(os.path.join(args.dir, "aot_flow", name))
+
+    if args.bf16:
+      # 需在 flow 被替换（--jit / --aot）之后注册，在 bf16 部分的入口处转换输入精度
+      for module in (self.net_g.flow, self.net_g.waveform_decoder):
+        module.register_forward_pre_hook(_to_bf16, with_kwargs=True)
+
+    if args.compile:
+      self._compile(os.path.join(args.dir, "inductor_cache"), decoder=not args.onnx)
+
     self.interface = self._gradio_interface()
 
+  def _freeze_flow(self):
+    # TorchScript 不支持倒序遍历 ModuleList，因此逐个 flow 转换并冻结，把 1x1 卷积的权重内联为常量
+    flow = self.net_g.flow
+    flow.remove_weight_norm()
+
+    # 只处理耦合层（Flip 已不再被调用），冻结后再跑一遍推理优化 pass，折叠常量卷积并融合逐元素运算
+    for i, layer in enumerate(flow.flows):
+      if isinstance(layer, ResidualCouplingLayer):
+        frozen = torch.jit.freeze(torch.jit.script(layer.eval()))
+        flow.flows[i] = torch.jit.optimize_for_inference(frozen)
+
+  def _aot_flow(self, cache_dir, buckets=(256, 512, 1024, 2048)):
+    # 编译产物内嵌了权重，文件名带上权重指纹，同名 checkpoint 重新训练后不会误用旧的产物
+    flow = self.net_g.flow
+    flow.remove_weight_norm()
+    dtype = next(flow.parameters()).dtype
+    digest = _state_hash(flow)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    runners = {}
+    for t in buckets:
+      path = os.path.join(cache_dir, "flow_{}_{}_{}.pt2".format(t, str(dtype).split(".")[-1], digest))
+
+      if not os.path.isfile(path):
+        x = torch.randn(1, flow.channels, t, dtype=dtype, device=self.device)
+        x_mask = torch.ones(1, 1, t, dtype=dtype, device=self.device)
+        g = torch.randn(1, flow.gin_channels, 1, dtype=dtype, device=self.device)
+
+        ep = torch.export.export(flow, (x, x_mask, g), {"reverse": True})
+        torch._inductor.aoti_compile_and_package(ep, package_path=path)
+
+      runners[t] = torch._inductor.aoti_load_package(path)
+
+    self.net_g.flow = AOTFlow(flow, runners)
+
+  def _export_decoder(self, path, digest):
+    import onnx
+
+    dec = self.net_g.waveform_decoder
+    dec.remove_weight_norm()
+
+    x = torch.randn(1, dec.conv_pre.in_channels, 32, device=self.device)
+    g = torch.randn(1, self.net_g.gin_channels, 1, device=self.device)
+
+    torch.onnx.export(
+      dec,
+      (x, g),
+      path,
+      input_names=["x", "g"],
+      output_names=["audio"],
+      opset_version=17,
+      dynamic_axes={"x": {0: "B", 2: "T"}, "g": {0: "B"}, "audio": {0: "B", 2: "T"}}
+    )
+
+    # 把权重指纹写入模型元数据，只改写图结构文件，外部权重文件保持不变
+    model = onnx.load(path, load_external_data=False)
+    onnx.helper.set_model_props(model, {"state_hash": digest})
+    onnx.save(model, path)
+
+  def _onnx_decoder(self, path):
+    # 解码器是纯卷积的静态图，交给 ONNX Runtime 执行；编码器等含动态控制流的部分仍留在 PyTorch
+    import onnxruntime as ort
+
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # 已有的导出文件只在权重指纹一致时复用，否则按当前 checkpoint 重新导出
+    digest = _state_hash(self.net_g.waveform_decoder)
+    session = None
+
+    if os.path.isfile(path):
+      session = ort.InferenceSession(path, sess_options=so, providers=["CPUExecutionProvider"])
+
+      if session.get_modelmeta().custom_metadata_map.get("state_hash") == digest:
+        utils.logger.info("Reusing ONNX waveform decoder {}".format(path))
+      else:
+        utils.logger.info("ONNX waveform decoder {} does not match the checkpoint, re-exporting".format(path))
+        session = None
+
+    if session is None:
+      self._export_decoder(path, digest)
+      session = ort.InferenceSession(path, sess_options=so, providers=["CPUExecutionProvider"])
+
+    def decode(decoder_inputs, sid=None):
+      g = self.net_g.emb_g(sid).unsqueeze(-1)
+      audio, = session.run(None, {
+        "x": decoder_inputs.float().cpu().numpy(),
+        "g": g.float().cpu().numpy()
+      })
+      return torch.from_numpy(audio)
+
+    return decode
+
+  def _compile(self, cache_dir, decoder=True):
+    # 把 Inductor 的编译产物持久化到磁盘，重启后直接命中缓存，避免冷启动时重新编译
+    # 环境中已显式设置的缓存目录优先
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+
+    # 文本长度不固定，放宽缓存上限，避免每个长度都重新编译
+    torch._dynamo.config.cache_size_limit = 64
+    # 保持与 eager 模式一致的随机数序列，同一个 seed 生成相同的音频
+    torch._inductor.config.fallback_random = True
+
+    # AOT 编译的 flow 已在 AOTFlow 中跳过 Dynamo
+    if not isinstance(self.net_g.flow, AOTFlow):
+      self.net_g.flow = CompiledFlow(self.net_g.flow)
+
+    self._infer_pre = torch.compile(
+      self.net_g.infer_pre_decoder, mode="reduce-overhead", fullgraph=False, dynamic=True
+    )
+
+    if decoder:
+      self._infer_dec = torch.compile(
+        self.net_g.infer_decode_chunk, mode="reduce-overhead", fullgraph=False, dynamic=True
+      )
+
+    self._warmup(decoder)
+
+  def _size_regimes(self, modules, run, min_len=3, max_len=None):
+    """
+    CPU 卷积按输入大小选择实现，torch.compile 会为每个大小区间各生成一份图。
+    以长度 1 和 2 各跑一次，记录 modules 中每个卷积的输入元素数，线性外推出各卷积越过阈值的长度，
+    再加上相对位置注意力改为填充的长度（window_size + 1），为每个区间返回一个长度。
+
+    :param modules: 输入长度随 run 的参数线性变化的模块
+    :param run: 以给定长度执行一次前向的函数
+    """
+
+    convs = [
+      m for module in modules for m in module.modules()
+      if isinstance(m, (torch.nn.Conv1d, torch.nn.ConvTranspose1d))
+    ]
+    sizes = {m: [] for m in convs}
+    handles = [m.register_forward_pre_hook(lambda m, args: sizes[m].append(args[0].numel())) for m in convs]
+
+    try:
+      run(1)
+      run(2)
+    finally:
+      for h in handles:
+        h.remove()
+
+    # 每个区间取紧挨着下界之上的长度
+    lengths = {min_len}
+    lengths.update(
+      m.window_size + 2 for module in modules for m in module.modules() if getattr(m, "window_size", None)
+    )
+
+    for n in sizes.values():
+      # 同一个卷积在一次前向中可能被调用多次，前一半记录来自长度 1，后一半来自长度 2
+      k = len(n) // 2
+      for a, b in zip(n[:k], n[k:]):
+        if b > a and a <= self.CONV_SIZE_LIMIT:
+          lengths.add((self.CONV_SIZE_LIMIT - a) // (b - a) + 2)
+
+    return sorted(n for n in lengths if n >= min_len and (max_len is None or n <= max_len))
+
+  def _warmup(self, decoder=True):
+    # 预先跑一遍，让 TorchInductor 生成并缓存内核，避免第一个请求过慢
+    # 输入经由与推理相同的 _make_inputs、以相同的参数传入，保证步长与参数一致
+    # 文本编码器按文本长度预热；flow 与解码器的帧长由预测的时长决定，直接构造各个帧长的输入预热
+    with torch.inference_mode():
+      speaker_id = torch.LongTensor([0]).to(self.device)
+      text_norm = torch.randint(1, len(symbols), (self.MAX_LEN,), device=self.device)
+      channels = self.net_g.waveform_decoder.conv_pre.in_channels
+      g = self.net_g.emb_g(speaker_id).unsqueeze(-1)
+      flow = self.net_g.flow
+
+      def flow_inputs(length):
+        x = torch.randn(1, self.net_g.inter_channels, length, device=self.device)
+        return x, torch.ones(1, 1, length, device=self.device)
+
+      # 探测用未编译的模块执行，不会触发编译
+      def probe_text(length):
+        x = text_norm[None, :length]
+        self.net_g.text_encoder(x, torch.zeros_like(x), torch.LongTensor([length]).to(self.device))
+
+      def probe_flow(length):
+        flow.flow(*flow_inputs(length), g=g, reverse=True)
+
+      def probe_dec(length):
+        self.net_g.waveform_decoder(torch.randn(1, channels, length, device=self.device), g=g)
+
+      for length in self._size_regimes([self.net_g.text_encoder], probe_text, max_len=self.MAX_LEN):
+        x_tst, t_tst, x_tst_lengths = self._make_inputs(text_norm[:length], torch.zeros_like(text_norm[:length]))
+
+        self._infer_pre(
+          x_tst,
+          t_tst,
+          x_tst_lengths,
+          sid=speaker_id,
+          noise_scale=0.667,
+          noise_scale_w=0.8,
+          length_scale=1.,
+          scope_shift=0
+        )
+
+      if isinstance(flow, CompiledFlow):
+        for length in self._size_regimes([flow.flow], probe_flow):
+          flow(*flow_inputs(length), g=g, reverse=True)
+
+      if decoder:
+        for length in self._size_regimes([self.net_g.waveform_decoder], probe_dec):
+          self._infer_dec(torch.randn(1, channels, length, device=self.device), sid=speaker_id)
+
   def get_phoneme(self, text):
-    cleaned_text, lang = clean_text(text)
-    text_norm = cleaned_text_to_sequence(cleaned_text)
+    cleaned_text, lang = _clean_text(text)
+    text_norm, lang = _text_to_ids(cleaned_text), list(lang)
 
     if self.hps.data.add_blank:
       text_norm, lang = commons.intersperse_with_language_id(text_norm, lang, 0)
@@ -57,30 +363,39 @@ class GradioApp:
 
     return text_norm, lang, cleaned_text
 
+  def _make_inputs(self, text_norm, tone):
+    # 在 CPU 上 .to 不拷贝，[None] 只是视图，不需要预分配缓冲区
+    x_tst = text_norm.to(self.device)[None]
+    t_tst = tone.to(self.device)[None]
+    x_tst_lengths = torch.LongTensor([text_norm.size(0)]).to(self.device)
+
+    return x_tst, t_tst, x_tst_lengths
+
   def inference(self, text, speaker_id_val, seed, scope_shift, duration):
     seed = int(seed)
     scope_shift = int(scope_shift)
     torch.manual_seed(seed)
     text_norm, tone, phones = self.get_phoneme(text)
-    x_tst = text_norm.to(self.device).unsqueeze(0)
-    t_tst = tone.to(self.device).unsqueeze(0)
-    x_tst_lengths = torch.LongTensor([text_norm.size(0)]).to(self.device)
-    speaker_id = torch.LongTensor([speaker_id_val]).to(self.device)
-
-    decoder_inputs, *_ = self.net_g.infer_pre_decoder(
-      x_tst,
-      t_tst,
-      x_tst_lengths,
-      sid=speaker_id,
-      noise_scale=0.667,
-      noise_scale_w=0.8,
-      length_scale=duration,
-      scope_shift=scope_shift
-    )
 
-    audio = self.net_g.infer_decode_chunk(
-      decoder_inputs, sid=speaker_id
-    )[0, 0].data.cpu().float().numpy()
+    # 梯度开关是线程局部的，Gradio 在工作线程中调用，这里需要显式进入 inference_mode
+    with torch.inference_mode():
+      x_tst, t_tst, x_tst_lengths = self._make_inputs(text_norm, tone)
+      speaker_id = torch.LongTensor([speaker_id_val]).to(self.device)
+
+      decoder_inputs, *_ = self._infer_pre(
+        x_tst,
+        t_tst,
+        x_tst_lengths,
+        sid=speaker_id,
+        noise_scale=0.667,
+        noise_scale_w=0.8,
+        length_scale=duration,
+        scope_shift=scope_shift
+      )
+
+      audio = self._infer_dec(
+        decoder_inputs, sid=speaker_id
+      )[0, 0].data.cpu().float().numpy()
 
     del decoder_inputs,
 
@@ -173,11 +488,43 @@ def parsearg():
     default='/DATA/audio/pits_samples',
     help='root dir'
   )
+  parser.add_argument(
+    '--onnx',
+    type=str,
+    help='Path to the ONNX waveform decoder, exported on first use (requires onnx, onnxscript and onnxruntime)'
+  )
+  parser.add_argument(
+    '--bf16',
+    action='store_true',
+    help='Run the flow and waveform decoder with bfloat16 weights'
+  )
+  flow_opt = parser.add_mutually_exclusive_group()
+  flow_opt.add_argument(
+    '--jit',
+    action='store_true',
+    help='Script and freeze the flow with TorchScript'
+  )
+  flow_opt.add_argument(
+    '--aot',
+    action='store_true',
+    help='Compile the flow ahead of time with AOTInductor for a few length buckets'
+  )
+  parser.add_argument(
+    '--compile',
+    action='store_true',
+    help='Compile the inference path with torch.compile'
+  )
   args = parser.parse_args()
   return args
 
 
 if __name__ == "__main__":
   args = parsearg()
+
+  # 推理是串行的流水线，inter-op 并行只会带来线程争用；进程级设置，只能在任何并行工作开始之前设置一次
+  # intra-op 线程数沿用 torch 的默认值，它已考虑 CPU 亲和性与容器的限制
+  if torch.get_num_interop_threads() != 1:
+    torch.set_num_interop_threads(1)
+
   app = GradioApp(args)
   app.launch()
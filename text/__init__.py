@@ -1,6 +1,29 @@
+import functools
+from types import MappingProxyType
+
+import numpy as np
+
 from text.symbols import symbols
 
-_symbol_to_id = {s: i for i, s in enumerate(symbols)}
+
+@functools.lru_cache(maxsize=None)
+def _get_symbol_to_id():
+  # 首次使用时才构建，只读映射可以在线程之间安全共享
+  return MappingProxyType({s: i for i, s in enumerate(symbols)})
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ord_to_id():
+  # 单字符符号的 Unicode 码位 -> id 查找表，整段文本只需一次向量化索引
+  symbol_to_id = _get_symbol_to_id()
+  ord_to_id = np.full(max(ord(s) for s in symbol_to_id if len(s) == 1) + 1, -1, dtype=np.int64)
+
+  for s, i in symbol_to_id.items():
+    if len(s) == 1:
+      ord_to_id[ord(s)] = i
+
+  ord_to_id.flags.writeable = False
+  return ord_to_id
 
 
 def cleaned_text_to_sequence(cleaned_text):
@@ -11,5 +34,17 @@ def cleaned_text_to_sequence(cleaned_text):
     Returns:
       List of integers corresponding to the symbols in the text
   """
-  sequence = [_symbol_to_id[symbol] for symbol in cleaned_text]
+  if isinstance(cleaned_text, str) and cleaned_text:
+    ord_to_id = _get_ord_to_id()
+    codes = np.frombuffer(cleaned_text.encode('utf-32-le'), dtype=np.uint32)
+
+    if codes.max() < ord_to_id.size:
+      ids = ord_to_id[codes]
+
+      if ids.min() >= 0:
+        return ids.tolist()
+
+  # 含有未知符号时回退到逐个查表，保持原有的 KeyError 行为
+  symbol_to_id = _get_symbol_to_id()
+  sequence = [symbol_to_id[symbol] for symbol in cleaned_text]
   return sequence
@@ -1,3 +1,4 @@
+import functools
 import re
 
 import cn2an
@@ -5,7 +6,7 @@ import cn2an
 # List of (Latin alphabet, bopomofo) pairs:
 from text.paddle_zh import zh_to_bopomofo, pinyin_to_bopomofo
 
-_latin_to_bopomofo = [(re.compile('%s' % x[0], re.IGNORECASE), x[1]) for x in [
+_latin_to_bopomofo = dict([
   ('a', 'ㄟˉ'),
   ('b', 'ㄅㄧˋ'),
   ('c', 'ㄙㄧˉ'),
@@ -32,10 +33,10 @@ _latin_to_bopomofo = [(re.compile('%s' % x[0], re.IGNORECASE), x[1]) for x in [
   ('x', 'ㄝˉㄎㄨˋㄙˋ'),
   ('y', 'ㄨㄞˋ'),
   ('z', 'ㄗㄟˋ')
-]]
+])
 
 # List of (bopomofo, ipa) pairs:
-_bopomofo_to_ipa = [(re.compile('%s' % x[0]), x[1]) for x in [
+_bopomofo_to_ipa = dict([
   ('ㄅㄛ', 'p⁼wo'),
   ('ㄆㄛ', 'pʰwo'),
   ('ㄇㄛ', 'mwo'),
@@ -94,26 +95,40 @@ _bopomofo_to_ipa = [(re.compile('%s' % x[0]), x[1]) for x in [
   ('！', '!'),
   ('？', '?'),
   ('—', '-')
-]]
+])
+
+
+def _compile_replacements(pairs, flags=0):
+  # 按长度降序合并为单个正则，一次扫描完成全部替换，长的组合优先于其前缀
+  # 每个键一个命名分组，回调用 lastgroup 取替换值；IGNORECASE 下 ſ、ı 等也会命中，不能靠 lower() 查表
+  keys = sorted(pairs, key=len, reverse=True)
+  pattern = re.compile('|'.join(f'(?P<k{i}>{re.escape(x)})' for i, x in enumerate(keys)), flags)
+  values = {f'k{i}': pairs[x] for i, x in enumerate(keys)}
+  return pattern, values
+
+
+_latin_to_bopomofo_re, _latin_to_bopomofo_values = _compile_replacements(_latin_to_bopomofo, re.IGNORECASE)
+_bopomofo_to_ipa_re, _bopomofo_to_ipa_values = _compile_replacements(_bopomofo_to_ipa)
+
+
+_number_re = re.compile(r'\d+(?:\.\d+)?')
+
+
+@functools.lru_cache(maxsize=1024)
+def _an2cn(number):
+  return cn2an.an2cn(number)
 
 
 def number_to_chinese(text):
-  numbers = re.findall(r'\d+(?:\.?\d+)?', text)
-  for number in numbers:
-    text = text.replace(number, cn2an.an2cn(number), 1)
-  return text
+  return _number_re.sub(lambda x: _an2cn(x.group()), text)
 
 
 def latin_to_bopomofo(text):
-  for regex, replacement in _latin_to_bopomofo:
-    text = re.sub(regex, replacement, text)
-  return text
+  return _latin_to_bopomofo_re.sub(lambda x: _latin_to_bopomofo_values[x.lastgroup], text)
 
 
 def bopomofo_to_ipa(text):
-  for regex, replacement in _bopomofo_to_ipa:
-    text = re.sub(regex, replacement, text)
-  return text
+  return _bopomofo_to_ipa_re.sub(lambda x: _bopomofo_to_ipa_values[x.lastgroup], text)
 
 
 def chinese_to_ipa(text):
@@ -130,11 +145,23 @@ def pinyin_to_ipa(text):
   return text
 
 
+# 四条 IPA 后处理规则互不重叠，合并为一个正则，一次扫描完成
+_zh_ipa_fix_re = re.compile('i([aoe])|u([aoəe])|([sɹ]`[⁼ʰ]?)([→↓↑ ]+|$)|(s[⁼ʰ]?)([→↓↑ ]+|$)')
+
+
+def _zh_ipa_fix(x):
+  if x.group(1) is not None:
+    return 'j' + x.group(1)
+  if x.group(2) is not None:
+    return 'w' + x.group(2)
+  if x.group(3) is not None:
+    return x.group(3) + 'ɹ`' + x.group(4)
+  return x.group(5) + 'ɹ' + x.group(6)
+
+
 def _clean_zh(text):
   text = latin_to_bopomofo(text)
   text = bopomofo_to_ipa(text)
-  text = re.sub('i([aoe])', r'j\1', text)
-  text = re.sub('u([aoəe])', r'w\1', text)
-  text = re.sub('([sɹ]`[⁼ʰ]?)([→↓↑ ]+|$)', r'\1ɹ`\2', text).replace('ɻ', 'ɹ`')
-  text = re.sub('(s[⁼ʰ]?)([→↓↑ ]+|$)', r'\1ɹ\2', text)
+  # ɻ 的替换必须在卷舌规则之后，否则新产生的 ɹ` 会被再次匹配
+  text = _zh_ipa_fix_re.sub(_zh_ipa_fix, text).replace('ɻ', 'ɹ`')
   return text